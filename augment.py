@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import math
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as f
+from PIL import Image
+from torchvision.io import ImageReadMode, decode_image, decode_jpeg
+
+
+class ToUint8Tensor(object):
+    """Converts a PIL image to a CHW uint8 tensor, a quarter of the bytes of ToTensor"""
+
+    def __call__(self, image: Image.Image) -> torch.Tensor:
+        return torch.from_numpy(np.array(image)).permute(2, 0, 1).contiguous()
+
+
+class Normalize(nn.Module):
+    """Converts a batch of uint8 images to float and normalizes it with per-channel mean and std"""
+
+    def __init__(self, mean: list[float], std: list[float]):
+        super().__init__()
+        mean = torch.tensor(mean).view(1, -1, 1, 1)
+        std = torch.tensor(std).view(1, -1, 1, 1)
+        # (x / 255 - mean) / std folded into a single multiply-add
+        self.register_buffer('scale', 1 / (255 * std))
+        self.register_buffer('shift', -mean / std)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.addcmul(self.shift, x.float(), self.scale)
+
+
+class RandomCropFlip(nn.Module):
+    """Randomly crops and horizontally flips every image of a batch in a single gather"""
+
+    def __init__(self, size: int, padding: int = 4, padding_mode: str = 'reflect'):
+        super().__init__()
+        self.size = size
+        self.padding = padding
+        self.padding_mode = padding_mode
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        b, c = x.shape[:2]
+        p = self.padding
+        x = f.pad(x, (p, p, p, p), mode=self.padding_mode)
+        # per-image crop offsets and flip decisions
+        top = torch.randint(0, x.size(2) - self.size + 1, (b, 1), device=x.device)
+        left = torch.randint(0, x.size(3) - self.size + 1, (b, 1), device=x.device)
+        flip = torch.rand(b, 1, device=x.device) < 0.5
+        pos = torch.arange(self.size, device=x.device).unsqueeze(0)
+        rows = top + pos
+        # a flipped crop reads its columns right to left
+        cols = left + torch.where(flip, self.size - 1 - pos, pos)
+        batch_idx = torch.arange(b, device=x.device).view(b, 1, 1, 1)
+        chan_idx = torch.arange(c, device=x.device).view(1, c, 1, 1)
+        return x[batch_idx, chan_idx, rows.view(b, 1, -1, 1), cols.view(b, 1, 1, -1)]
+
+
+class RandomResizedCropFlip(nn.Module):
+    """Randomly crops, resizes and horizontally flips images of any size with a single interpolation"""
+
+    def __init__(self, size: int, scale: tuple[float, float] = (0.08, 1.0),
+                 ratio: tuple[float, float] = (3 / 4, 4 / 3), tries: int = 10):
+        super().__init__()
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.tries = tries
+
+    def forward(self, images: list[torch.Tensor]) -> torch.Tensor:
+        b, c = len(images), images[0].size(0)
+        device = images[0].device
+        shape = torch.tensor([image.shape[1:] for image in images], dtype=torch.float, device=device)
+        height, width = shape[:, :1], shape[:, 1:]
+        # sample crop boxes as RandomResizedCrop does, keeping the first one that fits
+        area = height * width * torch.empty(b, self.tries, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(b, self.tries, device=device).uniform_(math.log(self.ratio[0]),
+                                                                        math.log(self.ratio[1]))
+        w = torch.sqrt(area * torch.exp(log_ratio))
+        h = torch.sqrt(area / torch.exp(log_ratio))
+        fits = (w <= width) & (h <= height)
+        first = fits.int().argmax(dim=1, keepdim=True)
+        found = fits.any(dim=1)
+        height, width = height.squeeze(1), width.squeeze(1)
+        # images without a fitting box fall back to a center crop with the ratio clamped
+        in_ratio = width / height
+        center_w = torch.where(in_ratio > self.ratio[1], height * self.ratio[1], width)
+        center_h = torch.where(in_ratio < self.ratio[0], width / self.ratio[0], height)
+        w = torch.where(found, w.gather(1, first).squeeze(1), center_w)
+        h = torch.where(found, h.gather(1, first).squeeze(1), center_h)
+        left = torch.where(found, torch.rand(b, device=device), 0.5) * (width - w)
+        top = torch.where(found, torch.rand(b, device=device), 0.5) * (height - h)
+        flip = torch.where(torch.rand(b, device=device) < 0.5, -1., 1.)
+
+        # affine map from the output grid to the crop box, a negative x scale flips it
+        theta = torch.zeros(b, 2, 3, device=device)
+        theta[:, 0, 0] = flip * w / width
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+        grid = f.affine_grid(theta, [b, c, self.size, self.size], align_corners=False)
+
+        # images of the same size are sampled together, so only their own pixels
+        # are converted to float. One index transfer orders the batch by size
+        groups = {}
+        for i, image in enumerate(images):
+            groups.setdefault(tuple(image.shape[1:]), []).append(i)
+        order = torch.tensor([i for indices in groups.values() for i in indices], device=device)
+        grid = grid[order]
+        out, start = [], 0
+        for indices in groups.values():
+            batch = torch.stack([images[i] for i in indices]).float()
+            out.append(f.grid_sample(batch, grid[start:start + len(indices)], mode='bilinear',
+                                     padding_mode='border', align_corners=False))
+            start += len(indices)
+        # back to the batch order of the labels
+        return torch.cat(out)[torch.argsort(order)]
+
+
+class DecodeJpeg(nn.Module):
+    """Decodes a batch of JPEGs on the GPU, optionally bringing every image to the same size"""
+
+    def __init__(self, transform: nn.Module = None):
+        super().__init__()
+        self.transform = transform
+
+    @staticmethod
+    def decode(data: torch.Tensor) -> torch.Tensor:
+        try:
+            return decode_jpeg(data, mode=ImageReadMode.RGB, device='cuda')
+        except RuntimeError:
+            return decode_image(data, mode=ImageReadMode.RGB).cuda()
+
+    def forward(self, data: list[torch.Tensor]) -> torch.Tensor | list[torch.Tensor]:
+        try:
+            images = decode_jpeg(data, mode=ImageReadMode.RGB, device='cuda')
+        except RuntimeError:
+            # a few ImageNet files are PNGs or CMYK JPEGs the GPU decoder rejects,
+            # the batch is then decoded image by image with a CPU fallback
+            images = [self.decode(image) for image in data]
+        if self.transform is None:
+            return images
+        return torch.stack([self.transform(image) for image in images])
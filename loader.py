@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import math
+
+import torch
+import torchvision.datasets as datasets
+from torchvision.io import read_file
+
+
+class TensorLoader(object):
+    """Iterates in batches over a dataset held in memory as a pair of tensors"""
+
+    def __init__(self, images: torch.Tensor, labels: torch.Tensor, batch_size: int,
+                 shuffle: bool = False, drop_last: bool = False,
+                 rank: int = 0, world_size: int = 1, seed: int = 0):
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.generator = torch.Generator(device=labels.device)
+
+    def set_epoch(self, epoch: int):
+        """Sets the epoch used to seed the shuffling, as DistributedSampler does"""
+        self.epoch = epoch
+
+    def num_samples(self) -> int:
+        return len(self.labels) // self.world_size
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.num_samples() // self.batch_size
+        return math.ceil(self.num_samples() / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            # every process draws the same permutation, so their shards stay disjoint
+            self.generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.labels), generator=self.generator,
+                                     device=self.labels.device)
+        else:
+            indices = torch.arange(len(self.labels), device=self.labels.device)
+        indices = indices[self.rank:self.num_samples() * self.world_size:self.world_size]
+        for batch in indices.split(self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                break
+            yield self.images[batch], self.labels[batch]
+
+
+class JpegFolder(datasets.DatasetFolder):
+    """Image folder that yields the encoded JPEG bytes, leaving the decoding to the GPU"""
+
+    def __init__(self, root: str):
+        super().__init__(root, loader=read_file, extensions=('.jpg', '.jpeg'))
+
+
+def jpeg_collate(batch: list[tuple[torch.Tensor, int]]) -> tuple[list[torch.Tensor], torch.Tensor]:
+    """Collates encoded images of different lengths into a list"""
+    images, labels = zip(*batch)
+    return list(images), torch.tensor(labels)
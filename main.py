@@ -1,15 +1,24 @@
 import argparse
+import bisect
 import os
-import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn.parallel
 import torch.optim
 import torch.utils.data as data
 import torchvision.datasets as datasets
+from torchvision.transforms import v2
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.optim.lr_scheduler import MultiStepLR
+from torch.utils.data.distributed import DistributedSampler
 # used for logging to TensorBoard
-from tensorboard_logger import configure
+from torch.utils.tensorboard import SummaryWriter
 
+from augment import DecodeJpeg, Normalize, RandomCropFlip, RandomResizedCropFlip, ToUint8Tensor
+from loader import JpegFolder, TensorLoader, jpeg_collate
 from train import *
 
 parser = argparse.ArgumentParser(description='PyTorch DenseNet Training')
@@ -17,6 +26,8 @@ parser.add_argument('--epochs', default=300, type=int,
                     help='number of total epochs to run')
 parser.add_argument('--start-epoch', default=0, type=int,
                     help='manual epoch number (useful on restarts)')
+parser.add_argument('-j', '--num-workers', default=4, type=int,
+                    help='number of data loading workers (default: 4)')
 parser.add_argument('-b', '--batch-size', default=64, type=int,
                     help='mini-batch size (default: 64)')
 parser.add_argument('--lr', '--learning-rate', default=0.1, type=float,
@@ -24,6 +35,8 @@ parser.add_argument('--lr', '--learning-rate', default=0.1, type=float,
 parser.add_argument('--momentum', default=0.9, type=float, help='momentum')
 parser.add_argument('--weight-decay', '--wd', default=1e-4, type=float,
                     help='weight decay (default: 1e-4)')
+parser.add_argument('--val-every', default=5, type=int,
+                    help='validate every n epochs and in the last 10 epochs (default: 5)')
 parser.add_argument('--print-freq', '-p', default=10, type=int,
                     help='print frequency (default: 10)')
 parser.add_argument('--layers', default=100, type=int,
@@ -32,6 +45,8 @@ parser.add_argument('--growth', default=12, type=int,
                     help='number of new channels per layer (default: 12)')
 parser.add_argument('--droprate', default=0, type=float,
                     help='dropout probability (default: 0.0)')
+parser.add_argument('--label-smoothing', default=0.1, type=float,
+                    help='label smoothing of the loss (default: 0.1)')
 parser.add_argument('--no-augment', dest='augment', action='store_false',
                     help='whether to use standard augmentation (default: True)')
 parser.add_argument('--reduce', default=0.5, type=float,
@@ -46,83 +61,106 @@ parser.add_argument('--test', default='', type=str,
                     help='path to trained model (default: none)')
 parser.add_argument('--name', default='DenseNet_BC_100_12', type=str,
                     help='name of experiment')
+parser.add_argument('--no-amp', dest='amp', action='store_false',
+                    help='To not use automatic mixed precision')
+parser.add_argument('--no-compile', dest='compile', action='store_false',
+                    help='To not compile the model with torch.compile')
+parser.add_argument('--dist-url', default='tcp://127.0.0.1:23456', type=str,
+                    help='url used to set up distributed training')
 parser.add_argument('--tensorboard',
                     help='Log progress to TensorBoard', action='store_true')
 parser.set_defaults(bottleneck=True)
 parser.set_defaults(augment=True)
 parser.set_defaults(imagenet=False)
+parser.set_defaults(amp=True)
+parser.set_defaults(compile=True)
 
 best_prec1 = 0.
 args = Namespace
+# writes checkpoints in the background while training goes on
+checkpoint_executor = ThreadPoolExecutor(max_workers=1)
 
 
 def main():
-    global args, best_prec1
     args = parser.parse_args()
-    if args.tensorboard:
-        configure(f"runs/{args.name}")
+    if args.val_every < 1:
+        parser.error('--val-every must be at least 1')
+    # for training on multiple GPUs, one process is spawned per GPU.
+    # Use CUDA_VISIBLE_DEVICES=0,1 to specify which GPUs to use
+    world_size = 1 if args.test else torch.cuda.device_count()
+    if not args.imagenet:
+        # download once here, the workers would race each other on the same files
+        datasets.CIFAR10('../data', train=True, download=True)
+    if world_size > 1:
+        mp.spawn(main_worker, args=(world_size, args), nprocs=world_size)
+    else:
+        main_worker(0, world_size, args)
 
-    # Data loading code
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                     std=[0.229, 0.224, 0.225])
 
-    if args.imagenet:
-        if args.augment:
-            transform_train = transforms.Compose([
-                transforms.RandomResizedCrop(224),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ])
-        else:
-            transform_train = transforms.Compose([
-                transforms.ToTensor(),
-                normalize,
-            ])
-        transform_test = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ])
-    else:
-        if args.augment:
-            transform_train = transforms.Compose([
-                transforms.RandomCrop(32, padding=4),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ])
-        else:
-            transform_train = transforms.Compose([
-                transforms.ToTensor(),
-                normalize,
-            ])
-        transform_test = transforms.Compose([
-            transforms.ToTensor(),
-            normalize
-        ])
+def main_worker(rank: int, world_size: int, cli_args: Namespace):
+    global args, best_prec1
+    args = cli_args
+    args.distributed = world_size > 1
+    torch.cuda.set_device(rank)
+    if args.distributed:
+        dist.init_process_group('nccl', init_method=args.dist_url,
+                                world_size=world_size, rank=rank)
+        # the batch size is split between the processes
+        args.batch_size //= world_size
+    # only the first process logs and saves checkpoints
+    writer = None
+    if args.tensorboard and rank == 0:
+        # events are buffered and flushed by a background thread
+        writer = SummaryWriter(f"runs/{args.name}", flush_secs=60)
+
+    # Data loading code, images cross PCIe as uint8 and are normalized batched on the GPU
+    transform_test = ToUint8Tensor()
+
+    kwargs = {'num_workers': args.num_workers, 'pin_memory': True}
+    if args.num_workers > 0:
+        # keep the workers and their prefetched batches alive between epochs
+        kwargs.update(persistent_workers=True, prefetch_factor=2)
 
     # Split dataset in train set and validation set
     if args.imagenet:
         folder = '../data/ILSVRC/Data/CLS-LOC/'
         traindir = os.path.join(folder, 'train')
         valdir = os.path.join(folder, 'val')
-        train_ds = datasets.ImageFolder(traindir, transform=transform_train)
-        val_ds = datasets.ImageFolder(valdir, transform=transform_test)
+        # the workers only read the JPEG files, they are decoded on the GPU
+        train_ds = JpegFolder(traindir)
+        val_ds = JpegFolder(valdir)
+
+        if args.distributed:
+            train_sampler = DistributedSampler(train_ds)
+            val_sampler = DistributedSampler(val_ds, shuffle=False)
+        else:
+            train_sampler, val_sampler = None, None
+
+        # drop the last partial batch so the compiled model sees a single input shape
+        train_loader = data.DataLoader(train_ds, batch_size=args.batch_size, shuffle=train_sampler is None,
+                                       sampler=train_sampler, drop_last=True, collate_fn=jpeg_collate, **kwargs)
+        val_loader = data.DataLoader(val_ds, batch_size=args.batch_size, shuffle=False,
+                                     sampler=val_sampler, drop_last=False, collate_fn=jpeg_collate, **kwargs)
     else:  # CIFAR-10
-        dataset = datasets.CIFAR10('../data', train=True, download=True, transform=transform_train)
+        dataset = datasets.CIFAR10('../data', train=True)
         test_ds = datasets.CIFAR10('../data', train=False, transform=transform_test)
         ds_size = len(dataset)
         val_size = int(0.1 * ds_size)
         train_size = ds_size - val_size
-        train_ds, val_ds = data.random_split(dataset, [train_size, val_size])
 
-    kwargs = {'num_workers': 4, 'pin_memory': True}
-    train_loader = data.DataLoader(train_ds, batch_size=args.batch_size, shuffle=True, **kwargs)
-    val_loader = data.DataLoader(val_ds, batch_size=args.batch_size, shuffle=True, **kwargs)
-    if not args.imagenet:
-        test_loader = data.DataLoader(test_ds, batch_size=args.batch_size, shuffle=True, **kwargs)
+        # the training set (~150 MB) is kept on the GPU as uint8 and batched by
+        # indexing, augmentation and normalization then run batched on the GPU.
+        # The split is fixed, the last 10% of the images are held out for validation
+        images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2)
+        labels = torch.tensor(dataset.targets)
+        train_loader = TensorLoader(images[:train_size].cuda(), labels[:train_size].cuda(),
+                                    args.batch_size, shuffle=True, drop_last=True,
+                                    rank=rank, world_size=world_size)
+        val_loader = TensorLoader(images[train_size:].cuda(), labels[train_size:].cuda(),
+                                  args.batch_size, rank=rank, world_size=world_size)
+        # the in-memory loader is reshuffled through the same per-epoch hook
+        train_sampler = train_loader
+        test_loader = data.DataLoader(test_ds, batch_size=args.batch_size, shuffle=False, **kwargs)
 
     # create model
     if args.imagenet:
@@ -132,94 +170,168 @@ def main():
         model = dn.DenseNet3(args.layers, 10, args.growth, reduction=args.reduce,
                              bottleneck=args.bottleneck, droprate=args.droprate)
 
+    # batched GPU transforms, the normalization constants are kept on the GPU
+    gpu_normalize = Normalize(mean=[0.485, 0.456, 0.406],
+                              std=[0.229, 0.224, 0.225]).cuda()
+    if args.imagenet:
+        resize_test = v2.Compose([
+            v2.Resize(256),
+            v2.CenterCrop(224),
+        ])
+        if args.augment:
+            # crop, resize and flip fused into a single bilinear pass per image
+            gpu_transform_train = nn.Sequential(DecodeJpeg(), RandomResizedCropFlip(224), gpu_normalize)
+        else:
+            gpu_transform_train = nn.Sequential(DecodeJpeg(resize_test), gpu_normalize)
+        gpu_transform_val = nn.Sequential(DecodeJpeg(resize_test), gpu_normalize)
+    else:
+        if args.augment:
+            gpu_transform_train = nn.Sequential(gpu_normalize, RandomCropFlip(32, padding=4))
+        else:
+            gpu_transform_train = gpu_normalize
+        gpu_transform_val = gpu_normalize
+
     # get the number of model parameters
     print(f'Number of model parameters: {sum([p.data.nelement() for p in model.parameters()])}')
 
-    # for training on multiple GPUs. 
-    # Use CUDA_VISIBLE_DEVICES=0,1 to specify which GPUs to use
-    # model = torch.nn.DataParallel(model).cuda()
-    model = model.cuda()
-
-    # optionally resume from a checkpoint
+    # optionally resume from a checkpoint. Checkpoints are memory-mapped and their tensors
+    # adopted by the model as they are, the only copy is the one made by .cuda() below
+    checkpoint = None
     if args.resume:
         if os.path.isfile(args.resume):
             print(f"=> loading checkpoint '{args.resume}'")
-            checkpoint = torch.load(args.resume)
+            checkpoint = torch.load(args.resume, map_location='cpu', mmap=True, weights_only=True)
             args.start_epoch = checkpoint['epoch']
             best_prec1 = checkpoint['best_prec1']
-            model.load_state_dict(checkpoint['state_dict'])
+            model.load_state_dict(checkpoint['state_dict'], assign=True)
             print(f"=> loaded checkpoint '{args.resume}' (epoch {checkpoint['epoch']})")
         else:
             print(f"=> no checkpoint found at '{args.resume}'")
 
-    cudnn.benchmark = True
-
     if args.test and not args.imagenet:
         args.test = f"runs/{args.test}/checkpoint.pth.tar"
-        if os.path.isfile(args.test):
-            print(f"=> loading model '{args.test}'")
-            checkpoint = torch.load(args.test)
-            args.start_epoch = checkpoint['epoch']
-            best_prec1 = checkpoint['best_prec1']
-            model.load_state_dict(checkpoint['state_dict'])
-            print(f"=> loaded model '{args.test}'")
-            test(test_loader, model, args)
-        else:
+        if not os.path.isfile(args.test):
             print(f"=> no model found at '{args.test}'")
+            return
+        print(f"=> loading model '{args.test}'")
+        checkpoint = torch.load(args.test, map_location='cpu', mmap=True, weights_only=True)
+        args.start_epoch = checkpoint['epoch']
+        best_prec1 = checkpoint['best_prec1']
+        model.load_state_dict(checkpoint['state_dict'], assign=True)
+        print(f"=> loaded model '{args.test}'")
+
+    model = model.cuda()
+    # NHWC lets cuDNN pick Tensor Core kernels for the convolutions
+    model = model.to(memory_format=torch.channels_last)
+
+    cudnn.benchmark = True
+    # TF32 Tensor Core kernels on Ampere and newer GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    if args.test and not args.imagenet:
+        test(test_loader, model, args, gpu_normalize)
         return
 
+    # gradients are all-reduced during the backward pass, overlapping with its compute.
+    # DenseNet has hundreds of small parameter tensors, so their gradients are kept as
+    # views into a few large flat buckets that NCCL reduces in one go
+    if args.distributed:
+        parallel_model = DDP(model, device_ids=[rank], bucket_cap_mb=50, gradient_as_bucket_view=True)
+    else:
+        parallel_model = model
+
+    # fuse the many small BN-ReLU-Conv and concat kernels, checkpoints
+    # are still taken from the unwrapped model to keep their keys unchanged
+    compiled_model = torch.compile(parallel_model, mode='max-autotune') if args.compile else parallel_model
+
     # define loss function (criterion) and optimizer
-    criterion = nn.CrossEntropyLoss().cuda()
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                nesterov=True,
-                                weight_decay=args.weight_decay)
+    criterion = nn.CrossEntropyLoss(label_smoothing=args.label_smoothing).cuda()
+    sgd_kwargs = {'momentum': args.momentum, 'nesterov': True, 'weight_decay': args.weight_decay}
+    try:
+        # update all the parameters with a single fused kernel
+        optimizer = torch.optim.SGD(model.parameters(), args.lr, fused=True, **sgd_kwargs)
+    except (TypeError, RuntimeError):
+        # older PyTorch releases only have the multi-tensor implementation
+        optimizer = torch.optim.SGD(model.parameters(), args.lr, foreach=True, **sgd_kwargs)
+    scaler = torch.amp.GradScaler('cuda', enabled=args.amp)
+    # decay the learning rate by 10 after 150 and 225 epochs (30 and 60 on ImageNet)
+    milestones = [30, 60] if args.imagenet else [150, 225]
+    last_epoch = -1
+    if args.start_epoch > 0 and (checkpoint is None or 'scheduler' not in checkpoint):
+        # without a scheduler state only the epoch is known. The scheduler starts from the
+        # epoch before, at that epoch's rate, and its first step brings it to start_epoch
+        last_epoch = args.start_epoch - 1
+        for group in optimizer.param_groups:
+            group['initial_lr'] = args.lr
+            group['lr'] = args.lr * 0.1 ** bisect.bisect_right(milestones, last_epoch)
+    scheduler = MultiStepLR(optimizer, milestones=milestones, gamma=0.1, last_epoch=last_epoch)
+    if checkpoint is not None and 'scheduler' in checkpoint:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        # the scheduler state does not include the optimizer's rate, which its steps build on
+        for group, lr in zip(optimizer.param_groups, scheduler.get_last_lr()):
+            group['lr'] = lr
 
+    pending_save = None
     for epoch in range(args.start_epoch, args.epochs):
-        adjust_learning_rate(optimizer, epoch)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        # log to TensorBoard
+        if writer is not None:
+            writer.add_scalar('learning_rate', scheduler.get_last_lr()[0], epoch)
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, args)
+        train(train_loader, compiled_model, criterion, optimizer, scaler, epoch, args,
+              gpu_transform_train, writer)
+
+        scheduler.step()
 
         # evaluate on validation set
-        prec1 = validate(val_loader, model, criterion, epoch, args)
-
-        # remember best prec@1 and save checkpoint
-        is_best = prec1 > best_prec1
-        best_prec1 = max(prec1, best_prec1)
-        save_checkpoint({
-            'epoch': epoch + 1,
-            'state_dict': model.state_dict(),
-            'best_prec1': best_prec1,
-        }, is_best)
+        is_best = False
+        if epoch % args.val_every == 0 or epoch >= args.epochs - 10:
+            prec1 = validate(val_loader, compiled_model, criterion, epoch, args, gpu_transform_val, writer)
+
+            # remember best prec@1
+            is_best = prec1 > best_prec1
+            best_prec1 = max(prec1, best_prec1)
+
+        # save checkpoint
+        if rank == 0:
+            if pending_save is not None:
+                # surface errors of the previous write
+                pending_save.result()
+            pending_save = save_checkpoint({
+                'epoch': epoch + 1,
+                'state_dict': {k: v.detach().cpu() for k, v in model.state_dict().items()},
+                'best_prec1': float(best_prec1),
+                'scheduler': scheduler.state_dict(),
+            }, is_best)
+    if pending_save is not None:
+        pending_save.result()
     print('Best accuracy: ', best_prec1)
+    if writer is not None:
+        writer.close()
 
-    if not args.imagenet:
-        test(test_loader, model, args)
+    if args.distributed:
+        dist.destroy_process_group()
 
+    if not args.imagenet and rank == 0:
+        test(test_loader, model, args, gpu_normalize)
 
-def save_checkpoint(state: dict, is_best: bool, filename: str = 'checkpoint.pth.tar'):
-    """Saves checkpoint to disk"""
+
+def save_checkpoint(state: dict, is_best: bool, filename: str = 'checkpoint.pth.tar') -> Future:
+    """Saves checkpoint to disk in a background thread"""
     directory = f"runs/{args.name}/"
     if not os.path.exists(directory):
         os.makedirs(directory)
     filename = directory + filename
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, f'runs/{args.name}/model_best.pth.tar')
 
+    def write():
+        torch.save(state, filename)
+        if is_best:
+            torch.save(state, f'runs/{args.name}/model_best.pth.tar')
 
-def adjust_learning_rate(optimizer: torch.optim.SGD, epoch: int):
-    """Sets the learning rate to the initial LR decayed by 10 after 150 and 225 epochs"""
-    if args.imagenet:
-        lr = args.lr * (0.1 ** (epoch // 30)) * (0.1 ** (epoch // 60))
-    else:
-        lr = args.lr * (0.1 ** (epoch // 150)) * (0.1 ** (epoch // 225))
-    # log to TensorBoard
-    if args.tensorboard:
-        log_value('learning_rate', lr, epoch)
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+    return checkpoint_executor.submit(write)
 
 
 if __name__ == '__main__':
@@ -3,15 +3,14 @@ from argparse import Namespace
 
 import numpy as np
 from matplotlib import pyplot as plt
-# used for logging to TensorBoard
-from tensorboard_logger import log_value
 
 import torch
 import torch.nn as nn
 import torch.nn.parallel
 import torch.optim
 from torch.utils.data import DataLoader
-import torchvision.transforms as transforms
+# used for logging to TensorBoard
+from torch.utils.tensorboard import SummaryWriter
 
 import densenet as dn
 from utils import *
@@ -21,7 +20,8 @@ classes = ("airplane", "automobile", "bird", "cat", "deer",
 
 
 def train(train_loader: DataLoader, model: dn.DenseNet3, criterion: nn.CrossEntropyLoss,
-          optimizer: torch.optim.SGD, epoch: int, args: Namespace):
+          optimizer: torch.optim.SGD, scaler: torch.amp.GradScaler, epoch: int, args: Namespace,
+          transform: nn.Module = None, writer: SummaryWriter = None):
     """Train for one epoch on the training set"""
     batch_time = AverageMeter()
     losses = AverageMeter()
@@ -34,11 +34,18 @@ def train(train_loader: DataLoader, model: dn.DenseNet3, criterion: nn.CrossEntr
     end = time.perf_counter()
     for i, (inp, target) in enumerate(train_loader):
         target: torch.Tensor = target.cuda(non_blocking=True)
-        inp: torch.Tensor = inp.cuda()
+        # JPEG batches are lists of encoded images, decoded by the transform
+        if isinstance(inp, torch.Tensor):
+            inp = inp.cuda(non_blocking=True)
+        if transform is not None:
+            inp = transform(inp)
+        inp = inp.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        output: torch.Tensor = model(inp)
-        loss: torch.Tensor = criterion(output, target)
+        with torch.autocast('cuda', dtype=torch.float16, enabled=args.amp):
+            output: torch.Tensor = model(inp)
+        # the loss reduction runs in float32
+        loss: torch.Tensor = criterion(output.float(), target)
 
         # measure accuracy and record loss
         if args.imagenet:
@@ -53,9 +60,11 @@ def train(train_loader: DataLoader, model: dn.DenseNet3, criterion: nn.CrossEntr
         losses.update(loss, inp.size(0))
 
         # compute gradient and do SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        # under DDP the gradients are views into its buckets, zeroing them keeps the views
+        optimizer.zero_grad(set_to_none=not args.distributed)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure elapsed time
         batch_time.update(time.perf_counter() - end)
@@ -68,15 +77,16 @@ def train(train_loader: DataLoader, model: dn.DenseNet3, criterion: nn.CrossEntr
                   f'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t'
                   f'Prec@5 {top5.val:.3f} ({top5.avg:.3f})' if args.imagenet else '')
     # log to TensorBoard
-    if args.tensorboard:
-        log_value('train_loss', losses.avg, epoch)
-        log_value('train_acc1', top1.avg, epoch)
+    if writer is not None:
+        writer.add_scalar('train_loss', losses.avg, epoch)
+        writer.add_scalar('train_acc1', top1.avg, epoch)
         if args.imagenet:
-            log_value('train_acc5', top5.avg, epoch)
+            writer.add_scalar('train_acc5', top5.avg, epoch)
 
 
+@torch.inference_mode()
 def validate(val_loader: DataLoader, model: dn.DenseNet3, criterion: nn.CrossEntropyLoss,
-             epoch: int, args: Namespace):
+             epoch: int, args: Namespace, transform: nn.Module = None, writer: SummaryWriter = None):
     """Perform validation on the validation set"""
     batch_time = AverageMeter()
     losses = AverageMeter()
@@ -89,12 +99,17 @@ def validate(val_loader: DataLoader, model: dn.DenseNet3, criterion: nn.CrossEnt
     end = time.perf_counter()
     for i, (inp, target) in enumerate(val_loader):
         target: torch.Tensor = target.cuda(non_blocking=True)
-        inp: torch.Tensor = inp.cuda()
+        # JPEG batches are lists of encoded images, decoded by the transform
+        if isinstance(inp, torch.Tensor):
+            inp = inp.cuda(non_blocking=True)
+        if transform is not None:
+            inp = transform(inp)
+        inp = inp.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        with torch.no_grad():
+        with torch.autocast('cuda', dtype=torch.float16, enabled=args.amp):
             output: torch.Tensor = model(inp)
-            loss: torch.Tensor = criterion(output, target)
+        loss: torch.Tensor = criterion(output.float(), target)
 
         # measure accuracy and record loss
         if args.imagenet:
@@ -119,19 +134,27 @@ def validate(val_loader: DataLoader, model: dn.DenseNet3, criterion: nn.CrossEnt
                   f'Prec@1 {top1.val:.3f} ({top1.avg:.3f})\t'
                   f'Prec@5 {top5.val:.3f} ({top5.avg:.3f})' if args.imagenet else '')
 
+    # gather the metrics of all the validation shards
+    if args.distributed:
+        losses.all_reduce()
+        top1.all_reduce()
+        if args.imagenet:
+            top5.all_reduce()
+
     print(f' * Prec@1 {top1.avg:.3f}')
     if args.imagenet:
         print(f' * Prec@5 {top5.avg:.3f}')
     # log to TensorBoard
-    if args.tensorboard:
-        log_value('val_loss', losses.avg, epoch)
-        log_value('val_acc1', top1.avg, epoch)
+    if writer is not None:
+        writer.add_scalar('val_loss', losses.avg, epoch)
+        writer.add_scalar('val_acc1', top1.avg, epoch)
         if args.imagenet:
-            log_value('val_acc5', top5.avg, epoch)
+            writer.add_scalar('val_acc5', top5.avg, epoch)
     return top1.avg
 
 
-def test(test_loader: DataLoader, model: dn.DenseNet3, args: Namespace):
+@torch.inference_mode()
+def test(test_loader: DataLoader, model: dn.DenseNet3, args: Namespace, transform: nn.Module = None):
     """Perform testing on the test set"""
     count = 0
     top1 = AverageMeter()
@@ -146,10 +169,11 @@ def test(test_loader: DataLoader, model: dn.DenseNet3, args: Namespace):
 
     for (images, labels) in test_loader:
         labels: torch.Tensor = labels.cuda(non_blocking=True)
-        images: torch.Tensor = images.cuda()
+        images: torch.Tensor = images.cuda(non_blocking=True)
 
-        with torch.no_grad():
-            outputs: torch.Tensor = model(images)
+        with torch.autocast('cuda', dtype=torch.float16, enabled=args.amp):
+            inp = transform(images) if transform is not None else images
+            outputs: torch.Tensor = model(inp.contiguous(memory_format=torch.channels_last))
 
         _, predicted = torch.max(outputs.cuda(), 1)
         # measure accuracy and record loss
@@ -179,11 +203,6 @@ def test(test_loader: DataLoader, model: dn.DenseNet3, args: Namespace):
                     break
             else:
                 count += 1
-                inv_trans = transforms.Compose([
-                    transforms.Normalize(mean=[0., 0., 0.], std=[1 / 0.229, 1 / 0.224, 1 / 0.225]),
-                    transforms.Normalize(mean=[-0.485, -0.456, -0.406], std=[1., 1., 1.])
-                ])
-                images = inv_trans(images)
                 print(f"Example [{count}]:")
                 print(f"Prediction: {classes[predicted[i]]}")
                 print(f"Label: {classes[labels[i]]}")
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import torch.distributed as dist
 import torch.utils.data
 
 
@@ -24,6 +25,13 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def all_reduce(self):
+        """Sums the meter over all the distributed processes"""
+        total = torch.tensor([float(self.sum), float(self.count)], device='cuda')
+        dist.all_reduce(total, dist.ReduceOp.SUM)
+        self.sum, self.count = total.tolist()
+        self.avg = self.sum / self.count if self.count else 0.
+
 
 def accuracy(output: torch.Tensor, target: torch.Tensor, topk: tuple = (1,)) -> list[torch.Tensor]:
     """Computes the precision@k for the specified values of k"""